@@ -1,18 +1,21 @@
-from typing import List, Dict, Tuple, Union
+from typing import List, Dict, Tuple, Union, Optional
 from pathlib import Path
-import math
 import random
 import json
+import warnings
+import importlib.util
 
 import argparse
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 
-from statistics import median, stdev
 import os
 import numpy as np
 import nibabel as nib
+from scipy.ndimage import find_objects
 from sklearn.model_selection import StratifiedKFold, train_test_split
 from interactivenet.utils.jsonencoders import NumpyEncoder
-from interactivenet.utils.utils import read_dataset
+from interactivenet.utils.utils import read_dataset, uncompressed_name
 
 
 class FingerPrint(object):
@@ -26,6 +29,9 @@ class FingerPrint(object):
         folds: int = 5,
         stratified: bool = True,
         leave_one_out: bool = False,
+        processes: Optional[int] = None,
+        cache: bool = False,
+        fastgeodis: bool = False,
     ) -> None:
         print("Initializing Fingerprinting")
         self.task = task
@@ -39,6 +45,15 @@ class FingerPrint(object):
         self.folds = folds
         self.leave_one_out = leave_one_out
         self.modalities = modalities
+        # Every process decodes a full volume, so keep the default bounded for memory
+        self.processes = processes if processes else min(os.cpu_count(), 4)
+        self.cache = cache
+        self.cache_path = self.processed_path / "cache"
+        if fastgeodis and importlib.util.find_spec("FastGeodis") is None:
+            raise ImportError(
+                "Please install FastGeodis (pip install FastGeodis) to process with the fastgeodis backend"
+            )
+        self.geodesic_backend = "fastgeodis" if fastgeodis else "geodistk"
 
         self.dim = []
         self.pixdim = []
@@ -62,35 +77,35 @@ class FingerPrint(object):
         print("Starting Fingerprinting: \n")
         print(f"Path: {self.raw_path}")
 
-        for entry in self.data:
-            image, label, interaction, subtype = (
-                entry["image"],
-                entry["label"],
-                entry["interaction"],
-                entry["class"],
-            )
-
-            name = Path(label).name.split(".")[0]
-            print(f"File: {name}")
-
-            image = nib.load(self.raw_path / image)
-            label = nib.load(self.raw_path / label)
-            inter = nib.load(self.raw_path / interaction)
-            self.sanity_same_metadata(image, label, inter)
-
-            self.dim.append(image.shape)
-            spacing = image.header.get_zooms()
-            self.pixdim.append(spacing)
-            self.anisotrophy.append(self.check_anisotrophy(spacing))
-            self.orientation.append(nib.orientations.aff2axcodes(image.affine))
-            self.sanity_annotation_in_mask(label, inter)
-            if self.ct:
-                self.get_normalization_strategy(image, label)
-
-            bbox = self.calculate_bbox(label)
-            self.bbox.append(bbox[1] - bbox[0])
-            self.classes.append(subtype)
-            self.names.append(name)
+        # Cases are independent, so they are fingerprinted in separate processes
+        in_mask = []
+        cached_sources = {}
+        with ProcessPoolExecutor(max_workers=self.processes) as executor:
+            for case in executor.map(self.fingerprint_case, self.data):
+                print(f"File: {case['name']}")
+                self.dim.append(case["dim"])
+                self.pixdim.append(case["pixdim"])
+                self.anisotrophy.append(case["anisotrophy"])
+                self.orientation.append(case["orientation"])
+                in_mask.append(case["in_mask"])
+                if self.ct:
+                    clipping, intensity_mean, intensity_std = case["normalization"]
+                    self.clipping.append(clipping)
+                    self.intensity_mean.append(intensity_mean)
+                    self.intensity_std.append(intensity_std)
+
+                self.bbox.append(case["bbox"])
+                self.classes.append(case["class"])
+                self.names.append(case["name"])
+                if self.cache:
+                    cached_sources.update(case["cache"])
+
+        if self.cache:
+            # Preprocessing only trusts the cache while the raw files are unchanged
+            with open(self.cache_path / "sources.json", "w") as f:
+                json.dump(cached_sources, f)
+
+        self.in_mask = all(in_mask)
 
         print("\nFingeprint:")
         print("- Database Structure: Correct")
@@ -98,9 +113,9 @@ class FingerPrint(object):
         print(f"- All images anisotropic: {all(self.anisotrophy)}")
 
         if self.ct:
-            self.clipping = [median(x) for x in zip(*self.clipping)]
-            self.intensity_mean = median(self.intensity_mean)
-            self.intensity_std = median(self.intensity_std)
+            self.clipping = np.median(self.clipping, axis=0).tolist()
+            self.intensity_mean = np.median(self.intensity_mean).item()
+            self.intensity_std = np.median(self.intensity_std).item()
             print("- CT: True")
             print(f"- Clipping to values: {self.clipping}")
             print(f"- Mean and stdev: {self.intensity_mean}, {self.intensity_std}")
@@ -109,9 +124,7 @@ class FingerPrint(object):
         self.target_spacing, self.resample_strategy = self.get_resampling_strategy(
             self.pixdim
         )
-        self.spacing_ratios = [
-            np.array(x) / np.array(self.target_spacing) for x in self.pixdim
-        ]
+        self.spacing_ratios = np.asarray(self.pixdim) / np.asarray(self.target_spacing)
         print(f"- Resampling strategy: {self.resample_strategy}")
         print(f"- Target spacing: {self.target_spacing}")
 
@@ -123,10 +136,7 @@ class FingerPrint(object):
         print(f"- Median shape of bbox: {self.median_bbox}")
 
         # Resampled shape -
-        self.resampled_shape = [
-            self.calculate_new_shape(x, y)
-            for x, y in zip(self.bbox, self.spacing_ratios)
-        ]
+        self.resampled_shape = (self.spacing_ratios * np.asarray(self.bbox)).astype(int)
         self.median_resampled_shape = self.calculate_median(self.resampled_shape)
         print(f"- Median shape of bbox after resampling: {self.median_resampled_shape}")
 
@@ -142,10 +152,9 @@ class FingerPrint(object):
         print(f"- Network selection: {self.strides} (strides)")
 
         # Get Final shape with right padding
-        self.final_shape = [
-            self.calculate_padded_shape(x, self.relax_bbox, self.divisible_by)
-            for x in self.resampled_shape
-        ]
+        self.final_shape = self.calculate_padded_shape(
+            self.resampled_shape, self.relax_bbox, self.divisible_by
+        )
         self.median_final_shape = self.calculate_median(self.final_shape)
         print(
             f"- Median shape of bbox after padding: {self.median_final_shape} (final shape)"
@@ -163,6 +172,71 @@ class FingerPrint(object):
         print("\n")
         self.save()
 
+    def fingerprint_case(self, entry: Dict[str, str]) -> dict:
+        image, label, interaction, subtype = (
+            entry["image"],
+            entry["label"],
+            entry["interaction"],
+            entry["class"],
+        )
+
+        name = Path(label).name.split(".")[0]
+
+        if self.cache:
+            # Taken before reading, so later edits of the raw data invalidate the cache
+            cached_sources = {}
+            for filename in (image, label, interaction):
+                source = (self.raw_path / filename).stat()
+                cached_sources[filename] = [source.st_mtime_ns, source.st_size]
+
+        image = nib.load(self.raw_path / image)
+        label = nib.load(self.raw_path / label)
+        inter = nib.load(self.raw_path / interaction)
+        self.sanity_same_metadata(image, label, inter)
+
+        # Decode every volume once and reuse the arrays for all checks
+        label_data = np.asanyarray(label.dataobj)
+        inter_data = np.asanyarray(inter.dataobj)
+        mask = self.threshold(label_data)
+        if self.cache or self.ct:
+            image_data = np.asanyarray(image.dataobj)
+
+        if self.cache:
+            for filename, img, data in zip(
+                (entry["image"], entry["label"], entry["interaction"]),
+                (image, label, inter),
+                (image_data, label_data, inter_data),
+            ):
+                self.cache_nifti(img, data, filename)
+
+        spacing = image.header.get_zooms()
+        bbox = self.calculate_bbox(mask)
+        case = {
+            "name": name,
+            "class": subtype,
+            "dim": image.shape,
+            "pixdim": spacing,
+            "anisotrophy": self.check_anisotrophy(spacing),
+            "orientation": nib.orientations.aff2axcodes(image.affine),
+            "in_mask": self.sanity_annotation_in_mask(label_data, inter_data),
+            "bbox": bbox[1] - bbox[0],
+        }
+        if self.ct:
+            case["normalization"] = self.get_normalization_strategy(image_data, mask)
+        if self.cache:
+            case["cache"] = cached_sources
+
+        return case
+
+    def cache_nifti(self, img, data: np.ndarray, filename: str):
+        # Uncompressed copy, so preprocessing doesn't have to decompress again
+        cached = type(img)(data, img.affine, img.header)
+        cached.set_data_dtype(data.dtype)
+
+        cache_file = self.cache_path / uncompressed_name(filename)
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        nib.save(cached, cache_file)
+
     def sanity_same_metadata(self, image, label, inter):
         def check(a, b, c, all_check=True):
             if all_check == True:
@@ -177,16 +251,19 @@ class FingerPrint(object):
                 "Metadata of image, mask and or annotation do not match"
             )
 
-    def sanity_annotation_in_mask(self, label, inter):
-        _check = True
-        for inds_x, inds_y, inds_z in np.column_stack(
-            (np.where(inter.get_fdata() > 0.5))
-        ):
-            if not label.dataobj[inds_x, inds_y, inds_z] == 1:
-                _check = False
-                warn.warning("Some annotations are not in the mask")
+    def threshold(self, data: np.ndarray) -> np.ndarray:
+        # Integer labels are compared as integers instead of casting them to float
+        if np.issubdtype(data.dtype, np.integer):
+            return data > 0
+        else:
+            return data > 0.5
 
-        self.in_mask = _check
+    def sanity_annotation_in_mask(self, label: np.ndarray, inter: np.ndarray):
+        _check = bool(np.all(label[self.threshold(inter)] == 1))
+        if not _check:
+            warnings.warn("Some annotations are not in the mask")
+
+        return _check
 
     def check_anisotrophy(self, spacing: Tuple[int]):
         def check(spacing):
@@ -195,15 +272,12 @@ class FingerPrint(object):
         return check(spacing)
 
     def check_orientation(self, orientations: List[Tuple]):
-        unique_orientations = list(set(orientations))
+        unique_orientations = [x for x, _ in Counter(orientations).most_common()]
         if len(unique_orientations) == 1:
             orientation_message = (
                 f"All images have the same orientation: {unique_orientations[0]}"
             )
         else:
-            from collections import Counter
-
-            unique_orientations = list(Counter(self.orientation).keys())
             orientation_message = f"Warning: Not all images have the same orientation, most are {unique_orientations[0]} but some also have {unique_orientations[1:]}\n  consider adjusting the orientation"
 
         return orientation_message
@@ -215,35 +289,34 @@ class FingerPrint(object):
         if self.anisotrophy.count(True) >= len(self.anisotrophy) / 2:
             index_max = np.argmax(target_spacing)
             target_spacing[index_max] = np.percentile(
-                list(zip(*spacing))[index_max], 10
+                np.asarray(spacing)[:, index_max], 10
             )
             strategy = "Anisotropic"
 
         return tuple(target_spacing), strategy
 
-    def get_normalization_strategy(self, image, label):
-        points = np.where(label.get_fdata() > 0.5)
-        points = image.get_fdata()[points]
-        self.clipping.append([np.percentile(points, 0.5), np.percentile(points, 99.5)])
-        self.intensity_mean.append(np.mean(points))
-        self.intensity_std.append(np.std(points))
+    def get_normalization_strategy(self, image: np.ndarray, mask: np.ndarray):
+        points = image[mask]
+        clipping = [np.percentile(points, 0.5), np.percentile(points, 99.5)]
+        return clipping, np.mean(points), np.std(points)
 
     def get_kernels_strides(self, sizes, spacings):
+        # All axes are updated at once, the number of levels depends on the min spacing
+        sizes = np.asarray(sizes, dtype=np.float64)
+        spacings = np.asarray(spacings, dtype=np.float64)
         strides, kernels = [], []
         while True:
-            spacing_ratio = [sp / min(spacings) for sp in spacings]
-            stride = [
-                2 if ratio <= 2 and size >= 8 else 1
-                for (ratio, size) in zip(spacing_ratio, sizes)
-            ]
-            kernel = [3 if ratio <= 2 else 1 for ratio in spacing_ratio]
-            if all(s == 1 for s in stride):
+            # Same as spacing / min(spacing) <= 2, shared by strides and kernels
+            isotropic = spacings <= 2 * spacings.min()
+            stride = np.where(isotropic & (sizes >= 8), 2, 1)
+            kernel = np.where(isotropic, 3, 1)
+            if np.all(stride == 1):
                 break
 
-            sizes = [i / j for i, j in zip(sizes, stride)]
-            spacings = [i * j for i, j in zip(spacings, stride)]
-            kernels.append(kernel)
-            strides.append(stride)
+            sizes = sizes / stride
+            spacings = spacings * stride
+            kernels.append(kernel.tolist())
+            strides.append(stride.tolist())
 
         strides.insert(0, len(spacings) * [1])
         kernels.append(len(spacings) * [3])
@@ -263,66 +336,46 @@ class FingerPrint(object):
         return d
 
     def calculate_median(self, item: List[Tuple], std: bool = False):
-        item = list(zip(*item))
+        item = np.asarray(item, dtype=np.float64)
+        medians = tuple(np.median(item, axis=0).tolist())
         if std == True:
-            return (
-                median(item[0]),
-                median(item[1]),
-                median(item[2]),
-                stdev(item[0]),
-                stdev(item[1]),
-                stdev(item[2]),
-            )
+            return medians + tuple(np.std(item, axis=0, ddof=1).tolist())
         else:
-            return (median(item[0]), median(item[1]), median(item[2]))
+            return medians
 
-    def calculate_bbox(self, data, relaxation=None):
-        inds_x, inds_y, inds_z = np.where(data.get_fdata() > 0.5)
+    def calculate_bbox(self, mask: np.ndarray, relaxation=None):
+        # Single pass in C over the mask, viewing the boolean mask as label 1
+        slices = find_objects(mask.view(np.uint8), max_label=1)[0]
+        if slices is None:
+            raise ValueError("Mask is empty, so no bounding box can be calculated")
+
+        inds_min = [x.start for x in slices]
+        inds_max = [x.stop - 1 for x in slices]
 
         if not relaxation:
             relaxation = [0, 0, 0]
 
         bbox = np.array(
             [
-                [
-                    np.min(inds_x) - relaxation[0],
-                    np.min(inds_y) - relaxation[1],
-                    np.min(inds_z) - relaxation[2],
-                ],
-                [
-                    np.max(inds_x) + relaxation[0],
-                    np.max(inds_y) + relaxation[1],
-                    np.max(inds_z) + relaxation[2],
-                ],
+                np.subtract(inds_min, relaxation),
+                np.add(inds_max, relaxation),
             ]
         )
 
         # Remove below zero and higher than shape because of relaxation
-        bbox[bbox < 0] = 0
-        largest_dimension = [
-            int(x) if x <= data.shape[i] else data.shape[i]
-            for i, x in enumerate(bbox[1])
-        ]
-        bbox = np.array([bbox[0].tolist(), largest_dimension])
+        bbox[0] = np.maximum(bbox[0], 0)
+        bbox[1] = np.minimum(bbox[1], mask.shape)
 
         return bbox
 
-    def calculate_new_shape(self, shape, spacing_ratio):
-        new_shape = (spacing_ratio * np.array(shape)).astype(int).tolist()
-        return new_shape
-
-    def calculate_padded_shape(self, shape, padding=0.1, divisible_by=None):
-        new_shape = [x + math.ceil(x * padding) for x in shape]
+    def calculate_padded_shape(self, shapes, padding=0.1, divisible_by=None):
+        # Shapes of all cases (N, 3) at once, divisible_by broadcasts over the axes
+        shapes = np.asarray(shapes)
+        new_shapes = shapes + np.ceil(shapes * padding).astype(int)
         if divisible_by:
-            if len(divisible_by) == 1:
-                divisible_by = [divisible_by] * len(new_shape)
+            new_shapes = new_shapes + (-new_shapes) % np.asarray(divisible_by)
 
-            for axis in range(len(new_shape)):
-                residue = new_shape[axis] % divisible_by[axis]
-                if residue != 0:
-                    new_shape[axis] = new_shape[axis] + residue
-
-        return new_shape
+        return new_shapes
 
     def crossval(self):
         if not self.seed:
@@ -397,6 +450,7 @@ class FingerPrint(object):
                 "deep supervision weights": self.supervision_weights,
                 "padding": self.relax_bbox,
                 "divisible by": self.divisible_by,
+                "geodesic backend": self.geodesic_backend,
                 "seed": self.seed,
                 "number of folds": self.folds,
                 "splits": self.splits,
@@ -459,6 +513,21 @@ def main():
         type=float,
         help="By how much do you want to relax the bounding box?",
     )
+    parser.add_argument(
+        "-p",
+        "--processes",
+        nargs="?",
+        default=None,
+        type=int,
+        help="How many processes do you want to use for fingerprinting? Each process holds a full volume in memory, so lower this for large (CT) datasets (default: number of cores, at most 4)",
+    )
+    parser.add_argument(
+        "-g",
+        "--fastgeodis",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Do you want to compute the geodesic distance maps with FastGeodis (GPU) instead of GeodisTK? This is stored in the plans, so inference uses the same backend",
+    )
     args = parser.parse_args()
 
     seed = args.seed
@@ -477,6 +546,8 @@ def main():
         folds=args.cross_validation_folds,
         stratified=args.stratified,
         leave_one_out=args.leave_one_out,
+        processes=args.processes,
+        fastgeodis=args.fastgeodis,
     )
     fingerprint()
 
@@ -8,12 +8,6 @@ import SimpleITK as sitk
 
 
 def sanity_check(images, labels, interactions, mode="Tr"):
-    def check(a, b, c=None):
-        if c:
-            return a == b == c
-        else:
-            return a == b
-
     len_images = len(images)
     if mode == "Tr":
         if not len(labels) % len_images == len(interactions) % len_images == 0:
@@ -21,24 +15,17 @@ def sanity_check(images, labels, interactions, mode="Tr"):
                 "Length of database is not correct, e.g. more labels or interactions than images"
             )
 
-    image_names = list(set(["_".join(x.name.split("_")[:-1]) for x in images]))
-    interaction_names = list(set([x.with_suffix("").stem for x in interactions]))
+    # Files are paired by their sorted position, so the ordered names have to match
+    image_names = ["_".join(x.name.split("_")[:-1]) for x in images]
+    interaction_names = [x.with_suffix("").stem for x in interactions]
     if mode == "Tr":
-        label_names = list(set([x.with_suffix("").stem for x in labels]))
-        if (
-            all(
-                [
-                    check(a, b, c)
-                    for a, b, c in zip(image_names, label_names, interaction_names)
-                ]
-            )
-            == False
-        ):
+        label_names = [x.with_suffix("").stem for x in labels]
+        if not image_names == label_names == interaction_names:
             raise AssertionError(
                 "images, labels and interactions do not have the correct names or are not ordered"
             )
     else:
-        if all([check(a, b) for a, b in zip(image_names, interaction_names)]) == False:
+        if not image_names == interaction_names:
             raise AssertionError(
                 "images and interactions do not have the correct names or are not ordered"
             )
@@ -63,7 +50,7 @@ def get_stats(inpath, all_subtypes=None):
             if not labels:
                 warnings.warn("No labels present for test set")
                 labels = len(images) * [""]
-                sanity_check(images, labels, interactions)
+                sanity_check(images, labels, interactions, mode="Ts")
             else:
                 sanity_check(images, labels, interactions, mode="Tr")
         else:
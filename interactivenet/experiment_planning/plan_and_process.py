@@ -1,4 +1,5 @@
 import os
+import shutil
 import argparse
 from pathlib import Path
 
@@ -49,6 +50,21 @@ def main():
         type=float,
         help="By how much do you want to relax the bounding box?",
     )
+    parser.add_argument(
+        "-p",
+        "--processes",
+        nargs="?",
+        default=None,
+        type=int,
+        help="How many processes do you want to use for fingerprinting? Each process holds a full volume in memory, so lower this for large (CT) datasets (default: number of cores, at most 4)",
+    )
+    parser.add_argument(
+        "-c",
+        "--cache",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Do you want to cache uncompressed volumes between fingerprinting and processing? This temporarily stores an uncompressed copy of the raw data",
+    )
     parser.add_argument(
         "-v",
         "--verbose",
@@ -56,6 +72,13 @@ def main():
         default=False,
         help="Do you want to run verbose and generate images?",
     )
+    parser.add_argument(
+        "-g",
+        "--fastgeodis",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Do you want to compute the geodesic distance maps with FastGeodis (GPU) instead of GeodisTK? This is stored in the plans, so inference uses the same backend",
+    )
     args = parser.parse_args()
 
     seed = args.seed
@@ -74,22 +97,31 @@ def main():
         folds=args.cross_validation_folds,
         stratified=args.stratified,
         leave_one_out=args.leave_one_out,
+        processes=args.processes,
+        cache=args.cache,
+        fastgeodis=args.fastgeodis,
     )
-    fingerprint()
+    try:
+        fingerprint()
 
-    preprocess = Preprocessing(
-        task=args.task,
-        data=data,
-        target_spacing=fingerprint.target_spacing,
-        relax_bbox=fingerprint.relax_bbox,
-        divisble_using=fingerprint.divisible_by,
-        clipping=fingerprint.clipping,
-        intensity_mean=fingerprint.intensity_mean,
-        intensity_std=fingerprint.intensity_std,
-        ct=fingerprint.ct,
-        verbose=args.verbose,
-    )
-    preprocess()
+        preprocess = Preprocessing(
+            task=args.task,
+            data=data,
+            target_spacing=fingerprint.target_spacing,
+            relax_bbox=fingerprint.relax_bbox,
+            divisble_using=fingerprint.divisible_by,
+            clipping=fingerprint.clipping,
+            intensity_mean=fingerprint.intensity_mean,
+            intensity_std=fingerprint.intensity_std,
+            ct=fingerprint.ct,
+            geodesic_backend=fingerprint.geodesic_backend,
+            verbose=args.verbose,
+        )
+        preprocess()
+    finally:
+        # Also remove a partial cache when fingerprinting or processing fails
+        if args.cache:
+            shutil.rmtree(fingerprint.cache_path, ignore_errors=True)
 
 
 if __name__ == "__main__":
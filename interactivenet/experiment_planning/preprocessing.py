@@ -1,6 +1,8 @@
 from typing import List, Tuple, Dict, Union
 from pathlib import Path
 import pickle
+import json
+import warnings
 
 import numpy as np
 import os
@@ -8,7 +10,12 @@ import argparse
 
 from monai.data import Dataset as MonaiDataset
 
-from interactivenet.utils.utils import read_dataset, read_metadata
+from interactivenet.utils.utils import (
+    read_dataset,
+    read_metadata,
+    uncompressed_name,
+    npz_to_npy,
+)
 from interactivenet.transforms.set_transforms import processing_transforms
 
 
@@ -24,15 +31,18 @@ class Preprocessing(MonaiDataset):
         intensity_mean: float = 0,
         intensity_std: float = 0,
         ct: bool = False,
+        geodesic_backend: str = "geodistk",
         verbose: bool = False,
     ) -> None:
         print("Initializing Preprocessing")
         self.task = task
         self.raw_path = Path(os.environ["interactivenet_raw"], task)
         self.processed_path = Path(os.environ["interactivenet_processed"], task)
+        self.cache_path = self.processed_path / "cache"
         self.create_directories()
 
-        self.data = data
+        self.data, self.source_path = self.use_cache(data)
+        self.names = [Path(item["label"]).with_suffix("").stem for item in self.data]
         self.target_spacing = target_spacing
         self.relax_bbox = relax_bbox
         self.divisble_using = divisble_using
@@ -40,17 +50,19 @@ class Preprocessing(MonaiDataset):
         self.intensity_mean = intensity_mean
         self.intensity_std = intensity_std
         self.ct = ct
+        self.geodesic_backend = geodesic_backend
         self.verbose = verbose
         self.transforms = processing_transforms(
             target_spacing=self.target_spacing,
             processed_path=self.processed_path,
-            raw_path=self.raw_path,
+            raw_path=self.source_path,
             relax_bbox=self.relax_bbox,
             divisble_using=self.divisble_using,
             clipping=self.clipping,
             intensity_mean=self.intensity_mean,
             intensity_std=self.intensity_std,
             ct=self.ct,
+            geodesic_backend=self.geodesic_backend,
             verbose=self.verbose,
         )
 
@@ -59,8 +71,7 @@ class Preprocessing(MonaiDataset):
     def __call__(self) -> None:
         print("\nPreprocessing:\n")
         metainfo = {}
-        for i, item in enumerate(self.data):
-            name = Path(item["label"]).with_suffix("").stem
+        for i, name in enumerate(self.names):
             print(f"File: {name}")
             item = self.__getitem__(i)
 
@@ -70,6 +81,35 @@ class Preprocessing(MonaiDataset):
         with open(self.processed_path / "metadata.pkl", "wb") as handle:
             pickle.dump(metainfo, handle, protocol=pickle.HIGHEST_PROTOCOL)
 
+    def use_cache(
+        self, data: List[Dict[str, str]]
+    ) -> Tuple[List[Dict[str, str]], Path]:
+        sources = self.cache_path / "sources.json"
+        if not sources.is_file():
+            return data, self.raw_path
+
+        with open(sources) as f:
+            sources = json.load(f)
+
+        keys = ["image", "interaction", "label"]
+        for item in data:
+            for key in keys:
+                source = (self.raw_path / item[key]).stat()
+                if not (self.cache_path / uncompressed_name(item[key])).is_file() or (
+                    sources.get(item[key]) != [source.st_mtime_ns, source.st_size]
+                ):
+                    warnings.warn(
+                        f"Cached volumes in {self.cache_path} are missing or older than the raw data, so using the raw data instead"
+                    )
+                    return data, self.raw_path
+
+        print(f"Using cached volumes from {self.cache_path}")
+        cached_data = [
+            {**item, **{key: str(uncompressed_name(item[key])) for key in keys}}
+            for item in data
+        ]
+        return cached_data, self.cache_path
+
     def create_directories(self) -> None:
         self.input_folder = self.processed_path / "network_input"
         self.input_folder.mkdir(parents=True, exist_ok=True)
@@ -105,8 +145,24 @@ def main():
         default=False,
         help="Do you want to run verbose and generate images?",
     )
+    parser.add_argument(
+        "-c",
+        "--convert_npz",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Only convert older compressed .npz network inputs to memory-mappable .npy, instead of processing the data again. The .npz files are kept",
+    )
     args = parser.parse_args()
 
+    if args.convert_npz:
+        network_input = Path(
+            os.environ["interactivenet_processed"], args.task, "network_input"
+        )
+        for npz_path in sorted(network_input.glob("*.npz")):
+            print(f"Converting {npz_path.name}")
+            npz_to_npy(npz_path)
+        return
+
     raw_path = Path(os.environ["interactivenet_raw"], args.task)
     data, modalities = read_dataset(raw_path)
 
@@ -125,6 +181,7 @@ def main():
         intensity_mean=plans["Fingerprint"]["Intensity_mean"],
         intensity_std=plans["Fingerprint"]["Intensity_std"],
         ct=plans["Fingerprint"]["CT"],
+        geodesic_backend=plans["Plans"].get("geodesic backend", "geodistk"),
         verbose=args.verbose,
     )
     preprocess()
@@ -61,6 +61,7 @@ def read_prediction(
 
                 for output, meta in zip(outputs, metas):
                     name = output.stem
+                    # Only references the niftis, volumes are read when results use them
                     raw = raw_data[name]
                     output = np.load(output)["weights"]
                     meta = read_pickle(meta)
@@ -1,16 +1,22 @@
 import argparse
 
 import os
+import warnings
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from typing import List, Dict, Optional, Union
 
 from pathlib import Path
 
+import numpy as np
+
+from monai.inferers import sliding_window_inference
 from monai.transforms import (
     EnsureType,
     MeanEnsemble,
 )
 
-from monai.data import Dataset, DataLoader, decollate_batch
+from monai.data import CacheDataset, DataLoader, decollate_batch
 
 from interactivenet.transforms.transforms import (
     OriginalSize,
@@ -29,6 +35,7 @@ from interactivenet.utils.mlflow import mlflow_get_runs
 
 import torch
 import pytorch_lightning as pl
+from pytorch_lightning.utilities import move_data_to_device
 
 import mlflow.pytorch
 from mlflow.utils.mlflow_tags import MLFLOW_PARENT_RUN_ID
@@ -43,14 +50,48 @@ class PredictModule(pl.LightningModule):
         model: str,
         accelerator: Optional[str] = "cuda",
         tta: bool = True,
+        dataset: Optional[CacheDataset] = None,
+        shared_model: Optional[torch.nn.Module] = None,
+        state_dict: Optional[str] = None,
+        compile: bool = False,
+        sliding_window: bool = False,
     ):
         super().__init__()
         if accelerator == "gpu":
             accelerator = "cuda"
 
-        self._model = mlflow.pytorch.load_model(
-            model, map_location=torch.device(accelerator)
-        )
+        if shared_model is not None:
+            # Same architecture for every fold, so only the weights are swapped in place
+            if state_dict is not None:
+                state_dict = mlflow.pytorch.load_state_dict(
+                    state_dict, map_location=torch.device("cpu")
+                )
+            else:
+                # Runs postprocessed before the state dict was logged only have the full model
+                state_dict = mlflow.pytorch.load_model(
+                    model, map_location=torch.device("cpu")
+                ).state_dict()
+
+            target = getattr(shared_model, "_orig_mod", shared_model)
+            if state_dict.keys() == target.state_dict().keys():
+                target.load_state_dict(state_dict)
+                self._model = shared_model
+            else:
+                # A checkpoint and a final model are logged as different modules
+                shared_model = None
+
+        if shared_model is None:
+            self._model = mlflow.pytorch.load_model(
+                model, map_location=torch.device(accelerator)
+            )
+            if compile:
+                if hasattr(torch, "compile"):
+                    # Default mode, CUDA graphs would be re-recorded for every crop size
+                    self._model = torch.compile(self._model.eval())
+                else:
+                    warnings.warn(
+                        "torch.compile requires torch>=2.0, so running the model uncompiled"
+                    )
         self.data = data
         self.metadata = metadata
         self.tta = tta
@@ -58,18 +99,50 @@ class PredictModule(pl.LightningModule):
         self.original_size = OriginalSize(metadata["Fingerprint"]["Anisotropic"])
         self.labels = all([idx["label"] != "" for idx in self.data])
         self.raw = Path(os.environ["interactivenet_raw"], task)
+        self.predict_ds = dataset
+
+        self.roi_size = None
+        if sliding_window:
+            # Window of the median training crop, made divisible for the network
+            divisible = np.asarray(metadata["Plans"]["divisible by"])
+            median = np.asarray(metadata["Fingerprint"]["Median final shape"])
+            self.roi_size = (
+                (np.ceil(median / divisible) * divisible).astype(int).tolist()
+            )
 
     def forward(self, x):
-        return self._model(x)
+        if self.roi_size:
+            return sliding_window_inference(
+                x,
+                roi_size=self.roi_size,
+                sw_batch_size=4,
+                predictor=self._model,
+                overlap=0.5,
+                mode="gaussian",
+            )
+        else:
+            return self._model(x)
+
+    def transfer_batch_to_device(self, batch, device, dataloader_idx):
+        # Only the network input is needed on the device, raw data and meta stay on the cpu
+        batch["image"] = batch["image"].to(device, non_blocking=True)
+        return batch
 
     def prepare_data(self):
+        if self.predict_ds is not None:
+            return
+
         transforms = inference_transforms(
             metadata=self.metadata, labels=self.labels, raw_path=self.raw
         )
 
-        self.predict_ds = Dataset(
+        # Inference transforms are deterministic, so the cache is shared between folds
+        self.predict_ds = CacheDataset(
             data=self.data,
             transform=transforms,
+            cache_rate=1.0,
+            num_workers=4,
+            copy_cache=False,
         )
 
     def predict_dataloader(self):
@@ -78,6 +151,7 @@ class PredictModule(pl.LightningModule):
             batch_size=1,
             shuffle=False,
             num_workers=4,
+            pin_memory=torch.cuda.is_available(),
         )
         return predict_loader
 
@@ -88,14 +162,15 @@ class PredictModule(pl.LightningModule):
             ensembling = MeanEnsemble()
 
             image = flip(image)
-            output = self.forward(image)
+            # Back to fp32 before ensembling, as the model may run under half precision
+            output = self.forward(image).float()
 
             flip.back = True
             output = flip(output)
             output = ensembling(output)
             output = [self.post_numpy(output)]
         else:
-            output = self.forward(image)
+            output = self.forward(image).float()
             output = [self.post_numpy(i) for i in decollate_batch(output)]
 
         meta = [
@@ -105,87 +180,199 @@ class PredictModule(pl.LightningModule):
             self.original_size(output, meta) for output, meta in zip(output, meta)
         ]
 
+        # The network input isn't used downstream, so it doesn't stay on the device
+        del batch["image"]
+
         return output, meta, batch
 
 
-def predict(
+def predict_fold(
+    run,
     data: List[Dict[str, str]],
     metadata: dict,
     task: str,
+    experiment_id: str,
     accelerator: Optional[str],
     devices: Optional[str],
     results: Optional[Union[str, os.PathLike]],
+    precision: Union[int, str] = 32,
     tta: bool = True,
     weights: bool = False,
     niftis: bool = False,
+    compile: bool = False,
+    sliding_window: bool = False,
+    dataset: Optional[CacheDataset] = None,
+    shared_model: Optional[torch.nn.Module] = None,
 ):
     mlflow.set_tracking_uri(results)
-    runs, experiment_id = mlflow_get_runs(task)
 
-    all_outputs = []
-    postprocessings = []
-    for idx, run in runs.iterrows():
-        if run["tags.Mode"] != "training":
-            continue
+    run_id = run["run_id"]
+    postprocessing = Path(
+        run["artifact_uri"].split("file://")[-1], "postprocessing.json"
+    )
+    postprocessing = read_metadata(
+        postprocessing,
+        error_message="postprocessing hasn't been run yet, please do this before predictions",
+    )
+    if postprocessing["using_checkpoint"]:
+        model = "runs:/" + run_id + "/model_checkpoint"
+    else:
+        model = "runs:/" + run_id + "/model"
 
-        run_id = run["run_id"]
-        run["params.fold"]
-        postprocessing = Path(
-            run["artifact_uri"].split("file://")[-1], "postprocessing.json"
-        )
-        postprocessing = read_metadata(
-            postprocessing,
-            error_message="postprocessing hasn't been run yet, please do this before predictions",
-        )
-        if postprocessing["using_checkpoint"]:
-            model = "runs:/" + run_id + "/model_checkpoint"
-        else:
-            model = "runs:/" + run_id + "/model"
+    state_dict = None
+    if Path(run["artifact_uri"].split("file://")[-1], "state_dict").exists():
+        state_dict = "runs:/" + run_id + "/state_dict"
 
-        network = PredictModule(
-            data=data,
+    network = PredictModule(
+        data=data,
+        metadata=metadata,
+        task=task,
+        model=model,
+        accelerator=accelerator,
+        tta=tta,
+        dataset=dataset,
+        shared_model=shared_model,
+        state_dict=state_dict,
+        compile=compile,
+        sliding_window=sliding_window,
+    )
+
+    # Required to log artifacts
+    trainer = pl.Trainer(
+        accelerator=accelerator,
+        devices=devices,
+        precision=precision,
+    )
+
+    with mlflow.start_run(
+        experiment_id=experiment_id,
+        tags={MLFLOW_PARENT_RUN_ID: run_id},
+        run_name="predict",
+    ) as run:
+        mlflow.set_tag("Mode", "testing")
+        mlflow.log_dict(postprocessing, "postprocessing.json")
+        outputs = trainer.predict(model=network)
+
+        if weights:
+            save_weights(mlflow, outputs)
+
+        if niftis:
+            save_niftis(
+                mlflow, outputs, postprocessing=postprocessing["postprocessing"]
+            )
+
+        AnalyzeResults(
+            mlflow=mlflow,
+            outputs=outputs,
+            postprocessing=postprocessing["postprocessing"],
             metadata=metadata,
-            task=task,
-            model=model,
-            accelerator=accelerator,
-            tta=tta,
+            labels=network.labels,
         )
 
-        # Required to log artifacts
-        trainer = pl.Trainer(
-            accelerator=accelerator,
-            devices=devices,
-        )
+    return outputs, postprocessing["postprocessing"], network
 
-        with mlflow.start_run(
-            experiment_id=experiment_id,
-            tags={MLFLOW_PARENT_RUN_ID: run_id},
-            run_name="predict",
-        ) as run:
-            mlflow.set_tag("Mode", "testing")
-            mlflow.log_dict(postprocessing, "postprocessing.json")
-            outputs = trainer.predict(model=network)
-
-            if weights:
-                save_weights(mlflow, outputs)
-
-            if niftis:
-                save_niftis(
-                    mlflow, outputs, postprocessing=postprocessing["postprocessing"]
-                )
 
-            AnalyzeResults(
-                mlflow=mlflow,
-                outputs=outputs,
-                postprocessing=postprocessing["postprocessing"],
-                metadata=metadata,
-                labels=network.labels,
+def set_visible_device(device: str):
+    # Runs before CUDA is initialised in the worker, so the fold only sees its own gpu
+    os.environ["CUDA_VISIBLE_DEVICES"] = device
+
+
+def predict_fold_on_device(**kwargs):
+    outputs, postprocessing, network = predict_fold(**kwargs)
+    # CUDA tensors would be sent as handles into this process, which exits after the fold
+    outputs = move_data_to_device(outputs, torch.device("cpu"))
+    return outputs, postprocessing, network.labels
+
+
+def predict(
+    data: List[Dict[str, str]],
+    metadata: dict,
+    task: str,
+    accelerator: Optional[str],
+    devices: Optional[str],
+    results: Optional[Union[str, os.PathLike]],
+    precision: Union[int, str] = 32,
+    tta: bool = True,
+    weights: bool = False,
+    niftis: bool = False,
+    compile: bool = False,
+    sliding_window: bool = False,
+    parallel_folds: bool = False,
+):
+    mlflow.set_tracking_uri(results)
+    runs, experiment_id = mlflow_get_runs(task)
+    runs = [run for _, run in runs.iterrows() if run["tags.Mode"] == "training"]
+
+    fold_kwargs = {
+        "data": data,
+        "metadata": metadata,
+        "task": task,
+        "experiment_id": experiment_id,
+        "accelerator": accelerator,
+        "results": results,
+        "precision": precision,
+        "tta": tta,
+        "weights": weights,
+        "niftis": niftis,
+        "compile": compile,
+        "sliding_window": sliding_window,
+    }
+
+    n_devices = torch.cuda.device_count() if accelerator == "gpu" else 0
+    if parallel_folds and n_devices > 1:
+        visible = os.environ.get("CUDA_VISIBLE_DEVICES")
+        visible = visible.split(",") if visible else [str(x) for x in range(n_devices)]
+
+        # One worker per gpu, every fold runs on a single gpu in its own process
+        pools = [
+            ProcessPoolExecutor(
+                max_workers=1,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=set_visible_device,
+                initargs=(visible[device],),
+            )
+            for device in range(n_devices)
+        ]
+        futures = [
+            pools[idx % n_devices].submit(
+                predict_fold_on_device, run=run, devices=1, **fold_kwargs
+            )
+            for idx, run in enumerate(runs)
+        ]
+        for pool in pools:
+            pool.shutdown(wait=True)
+
+        outputs = [future.result() for future in futures]
+        all_outputs = [output[0] for output in outputs]
+        postprocessings = [output[1] for output in outputs]
+        labels = outputs[-1][2]
+    else:
+        if parallel_folds:
+            warnings.warn(
+                "Predicting folds in parallel requires more than one gpu, so predicting them one by one"
             )
 
-            postprocessings.append(postprocessing["postprocessing"])
+        all_outputs = []
+        postprocessings = []
+        dataset = None
+        shared_model = None
+        for run in runs:
+            outputs, postprocessing, network = predict_fold(
+                run=run,
+                devices=devices,
+                dataset=dataset,
+                shared_model=shared_model,
+                **fold_kwargs,
+            )
+            postprocessings.append(postprocessing)
             all_outputs.append(outputs)
 
-    return all_outputs, postprocessings, network.labels
+            dataset = network.predict_ds
+            shared_model = network._model
+
+        labels = network.labels
+
+    return all_outputs, postprocessings, labels
 
 
 def main():
@@ -214,6 +401,27 @@ def main():
         default=False,
         help="Do you want to save weights as .npy in order to ensembling?",
     )
+    parser.add_argument(
+        "-c",
+        "--compile",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Do you want to compile the model with torch.compile (torch>=2.0)?",
+    )
+    parser.add_argument(
+        "-s",
+        "--sliding_window",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Do you want to predict large cases in windows of the median training shape?",
+    )
+    parser.add_argument(
+        "-f",
+        "--parallel_folds",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Do you want to predict the folds in parallel, one gpu per fold?",
+    )
 
     args = parser.parse_args()
     raw = Path(os.environ["interactivenet_raw"], args.task)
@@ -223,7 +431,7 @@ def main():
     data, modalities = read_dataset(raw, mode="test")
     metadata = read_metadata(exp / "plans.json")
 
-    accelerator, devices, _ = check_gpu()
+    accelerator, devices, precision = check_gpu()
 
     predict(
         data=data,
@@ -232,9 +440,13 @@ def main():
         accelerator=accelerator,
         devices=devices,
         results=results,
+        precision=precision,
         tta=args.tta,
         weights=args.weights,
         niftis=args.niftis,
+        compile=args.compile,
+        sliding_window=args.sliding_window,
+        parallel_folds=args.parallel_folds,
     )
 
 
@@ -88,6 +88,7 @@ class Refinement(pl.LightningModule):
                     powerof=2,
                     ct=self.metadata["Fingerprint"]["CT"],
                     backup=True,
+                    backend=self.metadata["Plans"].get("geodesic backend", "geodistk"),
                 ),
                 CastToTyped(
                     keys=["image", "annotation", "weights"],
@@ -53,13 +53,34 @@ def main():
         default=False,
         help="Do you want to save intermediate niftis and weights (before ensembling)?",
     )
+    parser.add_argument(
+        "-c",
+        "--compile",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Do you want to compile the model with torch.compile (torch>=2.0)?",
+    )
+    parser.add_argument(
+        "-s",
+        "--sliding_window",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Do you want to predict large cases in windows of the median training shape?",
+    )
+    parser.add_argument(
+        "-f",
+        "--parallel_folds",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Do you want to predict the folds in parallel, one gpu per fold?",
+    )
 
     args = parser.parse_args()
     raw = Path(os.environ["interactivenet_raw"], args.task)
     exp = Path(os.environ["interactivenet_processed"], args.task)
     results = Path(os.environ["interactivenet_results"], "mlruns")
 
-    accelerator, devices, _ = check_gpu()
+    accelerator, devices, precision = check_gpu()
 
     data, modalities = read_dataset(raw, mode="test")
     metadata = read_metadata(exp / "plans.json")
@@ -83,9 +104,13 @@ def main():
         accelerator=accelerator,
         devices=devices,
         results=results,
+        precision=precision,
         tta=args.tta,
         weights=args.intermediates,
         niftis=args.intermediates,
+        compile=args.compile,
+        sliding_window=args.sliding_window,
+        parallel_folds=args.parallel_folds,
     )
     ensemble(
         outputs=outputs,
@@ -9,7 +9,6 @@ from monai.utils import set_determinism
 from monai.transforms import (
     AsDiscrete,
     Compose,
-    ConcatItemsd,
     ToTensord,
     CastToTyped,
     KeepLargestConnectedComponent,
@@ -19,7 +18,7 @@ from monai.transforms import (
 from monai.metrics import DiceMetric
 from monai.data import Dataset, DataLoader, decollate_batch
 
-from interactivenet.transforms.transforms import LoadPreprocessed
+from interactivenet.transforms.transforms import LoadPreprocessed, ConcatCastToTensord
 from interactivenet.training.run import Net as TrainNet
 
 import torch
@@ -96,12 +95,9 @@ class PostprocessingModule(pl.LightningModule):
                 LoadPreprocessed(
                     keys=["npz", "metadata"], new_keys=["image", "interaction", "label"]
                 ),
-                CastToTyped(
-                    keys=["image", "interaction", "label"],
-                    dtype=(np.float32, np.float32, np.uint8),
-                ),
-                ConcatItemsd(keys=["image", "interaction"], name="image"),
-                ToTensord(keys=["image", "label"]),
+                ConcatCastToTensord(keys=["image", "interaction"], name="image"),
+                CastToTyped(keys=["label"], dtype=np.uint8),
+                ToTensord(keys=["label"]),
             ]
         )
 
@@ -114,7 +110,12 @@ class PostprocessingModule(pl.LightningModule):
         )
 
     def val_dataloader(self):
-        val_loader = DataLoader(self.val_ds, batch_size=1, num_workers=4)
+        val_loader = DataLoader(
+            self.val_ds,
+            batch_size=1,
+            num_workers=4,
+            pin_memory=torch.cuda.is_available(),
+        )
         return val_loader
 
     def validation_step(self, batch, batch_idx):
@@ -216,6 +217,14 @@ def run_postprocessing(
                 else:
                     postprocessing["postprocessing"] = False
 
+            # Weights only, so predicting several folds doesn't unpickle the network every time
+            model = (
+                network.checkpoint
+                if postprocessing["using_checkpoint"]
+                else network._model
+            )
+            mlflow.pytorch.log_state_dict(model.state_dict(), "state_dict")
+
             mlflow.log_dict(postprocessing, "postprocessing.json")
             mlflow.set_tag("Postprocessing", "Done")
 
@@ -9,7 +9,7 @@ from monai.transforms import AsDiscrete
 from monai.networks.nets import DynUNet
 from monai.metrics import DiceMetric
 from monai.losses import DiceCELoss
-from monai.data import Dataset, DataLoader, decollate_batch
+from monai.data import Dataset, CacheDataset, DataLoader, decollate_batch
 
 from interactivenet.transforms.set_transforms import training_transforms
 
@@ -21,6 +21,10 @@ import mlflow.pytorch
 from interactivenet.utils.mlflow import mlflow_get_id
 from interactivenet.utils.utils import read_processed, read_metadata, check_gpu
 
+# TF32 tensor cores for the fp32 parts that mixed precision leaves in fp32
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+
 
 class Net(pl.LightningModule):
     def __init__(
@@ -57,8 +61,14 @@ class Net(pl.LightningModule):
         self.best_val_epoch = 0
         self.max_epochs = 500
         self.batch_size = 1
+        self.num_workers = min(8, os.cpu_count())
         self.seed = self.metadata["Plans"]["seed"]
-        self.supervision_weights = metadata["Plans"]["deep supervision weights"]
+        # Buffer so it follows the model to its device, not part of the checkpoints
+        self.register_buffer(
+            "supervision_weights",
+            torch.tensor(metadata["Plans"]["deep supervision weights"]),
+            persistent=False,
+        )
 
     def forward(self, x):
         return self._model(x)
@@ -77,9 +87,13 @@ class Net(pl.LightningModule):
             data=train_data,
             transform=train_transforms,
         )
-        self.val_ds = Dataset(
+        # Validation transforms are deterministic, so they only have to run once
+        self.val_ds = CacheDataset(
             data=val_data,
             transform=val_transforms,
+            cache_rate=1.0,
+            num_workers=self.num_workers,
+            copy_cache=False,
         )
 
     def train_dataloader(self):
@@ -87,12 +101,21 @@ class Net(pl.LightningModule):
             self.train_ds,
             batch_size=self.batch_size,
             shuffle=True,
-            num_workers=4,
+            num_workers=self.num_workers,
+            pin_memory=torch.cuda.is_available(),
+            persistent_workers=True,
+            prefetch_factor=4,
         )
         return train_loader
 
     def val_dataloader(self):
-        val_loader = DataLoader(self.val_ds, batch_size=1, num_workers=4)
+        val_loader = DataLoader(
+            self.val_ds,
+            batch_size=1,
+            num_workers=self.num_workers,
+            pin_memory=torch.cuda.is_available(),
+            persistent_workers=True,
+        )
         return val_loader
 
     def configure_optimizers(self):
@@ -115,12 +138,10 @@ class Net(pl.LightningModule):
     def _compute_loss(self, outputs, labels):
         if len(outputs.size()) - len(labels.size()) == 1:
             outputs = torch.unbind(outputs, dim=1)
-            loss = sum(
-                [
-                    self.supervision_weights[i] * self.loss_function(output, labels)
-                    for i, output in enumerate(outputs)
-                ]
+            loss = torch.stack(
+                [self.loss_function(output, labels) for output in outputs]
             )
+            loss = torch.sum(self.supervision_weights * loss)
         else:
             loss = self.loss_function(outputs, labels)
 
@@ -150,10 +171,10 @@ class Net(pl.LightningModule):
         return {"val_loss": loss, "val_number": len(outputs)}
 
     def validation_epoch_end(self, outputs):
-        val_loss, num_items = 0, 0
-        for output in outputs:
-            val_loss += output["val_loss"].sum().item()
-            num_items += output["val_number"]
+        # Summed on the device, so there is only one sync for the whole epoch
+        val_loss = torch.stack([output["val_loss"].sum() for output in outputs])
+        val_loss = val_loss.sum().item()
+        num_items = sum([output["val_number"] for output in outputs])
 
         mean_val_dice = self.dice_metric.aggregate().item()
         self.dice_metric.reset()
@@ -219,6 +240,7 @@ def main():
             devices=devices,
             max_epochs=args.epochs,
             precision=precision,
+            benchmark=True,
             num_sanity_val_steps=1,
             log_every_n_steps=50,
             check_val_every_n_epoch=1,
@@ -7,11 +7,9 @@ from monai.transforms import (
     Compose,
     LoadImaged,
     EnsureChannelFirstd,
-    DivisiblePadd,
     Compose,
     RandFlipd,
     RandScaleIntensityd,
-    ConcatItemsd,
     ToTensord,
     RandGaussianNoised,
     RandGaussianSmoothd,
@@ -31,6 +29,7 @@ from interactivenet.transforms.transforms import (
     AddDirectoryd,
     SavePreprocessed,
     LoadPreprocessed,
+    ConcatCastToTensord,
 )
 
 
@@ -44,6 +43,7 @@ def processing_transforms(
     intensity_mean: float = 0,
     intensity_std: float = 0,
     ct: bool = False,
+    geodesic_backend: str = "geodistk",
     save: bool = True,
     verbose: bool = False,
     compose: bool = True,
@@ -99,9 +99,14 @@ def processing_transforms(
 
     transforms += [
         EGDMapd(
-            keys=["interaction"], image="image", lamb=1, iter=4, logscale=True, ct=ct
+            keys=["interaction"],
+            image="image",
+            lamb=1,
+            iter=4,
+            logscale=True,
+            ct=ct,
+            backend=geodesic_backend,
         ),
-        DivisiblePadd(keys=["image", "interaction", "label"], k=divisble_using),
     ]
 
     if verbose:
@@ -116,10 +121,12 @@ def processing_transforms(
 
     if save:
         transforms += [
+            # The EGD map is within [0, 1], so half precision is enough on disk
+            CastToTyped(keys=["interaction"], dtype=np.float16),
             SavePreprocessed(
                 keys=["image", "interaction", "label"],
                 save=processed_path / "network_input",
-            )
+            ),
         ]
 
     if compose:
@@ -136,6 +143,7 @@ def training_transforms(seed: Optional[int] = None, validation: bool = False):
         LoadPreprocessed(
             keys=["npz", "metadata"], new_keys=["image", "interaction", "label"]
         ),
+        CastToTyped(keys=["interaction"], dtype=np.float32),
     ]
 
     if not validation:
@@ -178,12 +186,9 @@ def training_transforms(seed: Optional[int] = None, validation: bool = False):
         ]
 
     transforms += [
-        CastToTyped(
-            keys=["image", "interaction", "label"],
-            dtype=(np.float32, np.float32, np.uint8),
-        ),
-        ConcatItemsd(keys=["image", "interaction"], name="image"),
-        ToTensord(keys=["image", "label"]),
+        ConcatCastToTensord(keys=["image", "interaction"], name="image"),
+        CastToTyped(keys=["label"], dtype=np.uint8),
+        ToTensord(keys=["label"]),
     ]
 
     return Compose(transforms)
@@ -241,13 +246,13 @@ def inference_transforms(
             iter=4,
             logscale=True,
             ct=metadata["Fingerprint"]["CT"],
+            # Plans from before the backend choice were always processed with GeodisTK
+            backend=metadata["Plans"].get("geodesic backend", "geodistk"),
         ),
     ]
 
     transforms += [
-        CastToTyped(keys=["image", "interaction"], dtype=(np.float32, np.float32)),
-        ToTensord(keys=["image", "interaction"]),
-        ConcatItemsd(keys=["image", "interaction"], name="image"),
+        ConcatCastToTensord(keys=["image", "interaction"], name="image"),
     ]
 
     return Compose(transforms)
@@ -6,12 +6,18 @@ import pickle
 import math
 from pathlib import Path
 import torch
+from torch.utils.data import get_worker_info
 from itertools import combinations
 
 from monai.transforms.transform import MapTransform, Transform
-from monai.transforms import NormalizeIntensity, GaussianSmooth, Flip
+from monai.transforms import NormalizeIntensity, GaussianSmooth
 import numpy as np
 import GeodisTK
+
+try:
+    import FastGeodis
+except ImportError:
+    FastGeodis = None
 from interactivenet.utils.utils import to_pathlib
 from interactivenet.utils.resample import (
     resample_image,
@@ -45,19 +51,12 @@ class TestTimeFlipping(Transform):
         for n in range(len(spatial_axis) + 1):
             all_combinations += list(combinations(spatial_axis, n))
 
+        # Flipping is its own inverse, so going back only changes which image is flipped
         new_image = [image[0]]
-        if not self.back:
-            for spatial_axis in all_combinations[1:]:
-                flipping = Flip(spatial_axis=spatial_axis)
-                new_image += torch.stack(
-                    [flipping(i[None, :]) for i in image[0]], dim=1
-                )
-
-        else:
-            for idx, spatial_axis in enumerate(all_combinations[1:], 1):
-                flipping = Flip(spatial_axis=spatial_axis)
-                img = image[idx]
-                new_image += torch.stack([flipping(i[None, :]) for i in img], dim=1)
+        for idx, spatial_axis in enumerate(all_combinations[1:], 1):
+            img = image[idx] if self.back else image[0]
+            # All channels are flipped at once, dim 0 being the channel
+            new_image.append(torch.flip(img, dims=[axis + 1 for axis in spatial_axis]))
 
         img = torch.stack(new_image)
         print("Shape output")
@@ -143,7 +142,9 @@ class OriginalSize(Transform):
 
         if self.resample:
             new_img = resample_image(
-                new_img, meta["org_dim"], anisotrophy_flag=meta["anisotrophy_flag"]
+                new_img,
+                meta["org_dim"],
+                anisotrophy_flag=meta["anisotrophy_flag"],
             )
 
         return new_img
@@ -294,6 +295,7 @@ class Visualized(MapTransform):
 class Resamplingd(MapTransform):
     """
     This transform class takes NNUNet's resampling method and applies it to our data structure.
+    The data dictionary is updated in place, it should be owned by the pipeline (e.g. come from LoadImaged).
     """
 
     def __init__(
@@ -303,14 +305,15 @@ class Resamplingd(MapTransform):
     ) -> None:
         super().__init__(keys)
         self.keys = keys
-        self.target_spacing = pixdim
+        self.target_spacing = tuple(pixdim)
+        self.target_spacing_array = np.asarray(pixdim, dtype=float)
 
     def calculate_new_shape(
         self,
         spacing_ratio: Union[np.ndarray, torch.Tensor],
         shape: Union[np.ndarray, torch.Tensor],
     ):
-        new_shape = (spacing_ratio * np.array(shape)).astype(int).tolist()
+        new_shape = [int(ratio * size) for ratio, size in zip(spacing_ratio, shape)]
         return new_shape
 
     def check_anisotrophy(self, spacing: List[float]):
@@ -324,20 +327,15 @@ class Resamplingd(MapTransform):
         interaction: Union[np.ndarray, torch.Tensor],
         label: Union[np.ndarray, torch.Tensor],
     ):
-        sanity = []
         for i, interaction_d in enumerate(interaction):
             label_d = label[i]
-            idx_x, idx_y, idx_z = np.where(interaction_d > 0.5)
-            sanity_d = []
-            for x, y, z in zip(idx_x, idx_y, idx_z):
-                sanity_d.append(label_d[x, y, z] == 1)
+            if not np.any(label_d[interaction_d > 0.5] == 1):
+                return False
 
-            sanity.append(not any(sanity_d))
-
-        return not any(sanity)
+        return True
 
     def __call__(self, data):
-        d = dict(data)
+        d = data
 
         if "image" in self.keys:
             message = "Resampling, image, "
@@ -357,20 +355,21 @@ class Resamplingd(MapTransform):
             label = d["label"]
             label[label < 0] = 0
 
-        image_spacings = d["image_meta_dict"]["pixdim"][1:4].tolist()
+        image_spacings = tuple(float(x) for x in d["image_meta_dict"]["pixdim"][1:4])
         print(
             f"Original Spacing: {image_spacings} \t Target Spacing: {self.target_spacing}"
         )
 
         # calculate shape
         original_shape = image.shape[1:]
+        resample_shape = list(original_shape)
         resample_flag = False
         anisotrophy_flag = False
 
         if self.target_spacing != image_spacings:
             print(message + "because current spacing != target spacing")
             resample_flag = True
-            spacing_ratio = np.array(image_spacings) / np.array(self.target_spacing)
+            spacing_ratio = np.array(image_spacings) / self.target_spacing_array
             resample_shape = self.calculate_new_shape(spacing_ratio, original_shape)
             print(f"Original Shape: {original_shape} \t Target Shape: {resample_shape}")
 
@@ -425,6 +424,7 @@ class Resamplingd(MapTransform):
 class BoudingBoxd(MapTransform):
     """
     This transform class takes the bounding box of an object based on the mask or annotations.
+    The data dictionary is updated in place, it should be owned by the pipeline (e.g. come from LoadImaged).
     """
 
     def __init__(
@@ -449,14 +449,13 @@ class BoudingBoxd(MapTransform):
         self.divisiblepadd = divisiblepadd
 
     def calculate_bbox(self, data: np.ndarray):
-        inds_x, inds_y, inds_z = np.where(data > 0.5)
+        mask = data > 0.5
 
-        bbox = np.array(
-            [
-                [np.min(inds_x), np.min(inds_y), np.min(inds_z)],
-                [np.max(inds_x), np.max(inds_y), np.max(inds_z)],
-            ]
-        )
+        bbox = np.zeros((2, mask.ndim), dtype=int)
+        for axis in range(mask.ndim):
+            other_axes = tuple(i for i in range(mask.ndim) if i != axis)
+            inds = np.flatnonzero(mask.any(axis=other_axes))
+            bbox[:, axis] = inds[0], inds[-1]
 
         return bbox
 
@@ -502,12 +501,7 @@ class BoudingBoxd(MapTransform):
                 )
 
         # Remove below zero and higher than shape because of relaxation
-        bbox[bbox < 0] = 0
-        largest_dimension = [
-            int(x) if x <= data.shape[i] else data.shape[i]
-            for i, x in enumerate(bbox[1])
-        ]
-        bbox = np.array([bbox[0].tolist(), largest_dimension])
+        bbox = np.clip(bbox, 0, data.shape)
 
         zeropadding = np.zeros(3)
         if self.divisiblepadd:
@@ -542,6 +536,9 @@ class BoudingBoxd(MapTransform):
                                 bbox[1][axis] = pos
 
                             if neg <= 0 and pos > data.shape[axis]:
+                                # The lower side may just have grown to 0, so take the residue again
+                                bbox_shape = np.subtract(bbox[1][axis], bbox[0][axis])
+                                residue = -bbox_shape % self.divisiblepadd[axis]
                                 zeropadding[axis] = zeropadding[axis] + residue
                                 warnings.warn(
                                     f"bbox doesn't fit in the image for axis {axis}, adding zero padding {residue}"
@@ -580,8 +577,7 @@ class BoudingBoxd(MapTransform):
         return new_region
 
     def __call__(self, data):
-        d = dict(data)
-        list(self.key_iterator(d))
+        d = data
 
         bbox = self.calculate_bbox(d[self.on][0])
         bbox_shape = np.subtract(bbox[1], bbox[0])
@@ -650,9 +646,14 @@ class NormalizeValuesd(MapTransform):
         for key in self.keys:
             image = d[key]
             if self.clipping:
-                d[f"{key}_EGD"] = (image - self.mean) / self.std
-                image = np.clip(image, self.clipping[0], self.clipping[1])
-                image = (image - self.mean) / self.std
+                # Normalised once, clipping is then done on the normalised bounds
+                image = image - self.mean
+                image /= self.std
+                d[f"{key}_EGD"] = image
+                low, high = (
+                    np.asarray(self.clipping, image.dtype) - self.mean
+                ) / self.std
+                image = image.clip(low, high)
             else:
                 image = self.normalize_intensity(image.copy())
 
@@ -666,6 +667,7 @@ class EGDMapd(MapTransform):
     This transform class creates an exponetialized geodesic distance map, based on an image and annotations.
     For more information you can look into:
     https://github.com/taigw/GeodisTK
+    The data dictionary is updated in place, it should be owned by the pipeline (e.g. come from LoadImaged).
     """
 
     def __init__(
@@ -678,6 +680,7 @@ class EGDMapd(MapTransform):
         ct: bool = False,
         backup: bool = False,
         powerof: bool = False,
+        backend: str = "geodistk",
     ) -> None:
         super().__init__(keys)
         self.keys = keys
@@ -690,8 +693,71 @@ class EGDMapd(MapTransform):
         self.powerof = powerof
         self.gaussiansmooth = GaussianSmooth(sigma=1)
 
+        # The backends don't give identical maps, so the plans fix which one is used
+        if backend not in ["geodistk", "fastgeodis"]:
+            raise ValueError(
+                f"Geodesic backend should be either geodistk or fastgeodis, not {backend}"
+            )
+        if backend == "fastgeodis" and FastGeodis is None:
+            raise ImportError(
+                "The plans use the fastgeodis backend, please install FastGeodis (pip install FastGeodis)"
+            )
+        self.backend = backend
+
+    def geodesic_map(
+        self, image: np.ndarray, annotation: np.ndarray, spacing: np.ndarray
+    ):
+        if self.backend == "fastgeodis":
+            return self.geodesic_map_fastgeodis(image, annotation, spacing)
+
+        # The raster scan itself is compiled code in GeodisTK
+        GD = GeodisTK.geodesic3d_raster_scan(
+            image.astype(np.float32),
+            annotation.astype(np.uint8),
+            spacing.astype(np.float32),
+            self.lamb,
+            self.iter,
+        )
+        # GD is a fresh array from GeodisTK, so it can be updated in place
+        if self.powerof:
+            np.power(GD, self.powerof, out=GD)
+
+        if self.logscale == True:
+            np.negative(GD, out=GD)
+            np.exp(GD, out=GD)
+
+        return GD
+
+    def geodesic_map_fastgeodis(
+        self, image: np.ndarray, annotation: np.ndarray, spacing: np.ndarray
+    ):
+        # CUDA can't be used from forked dataloader workers, those run the same kernel on the cpu
+        if torch.cuda.is_available() and get_worker_info() is None:
+            device = "cuda"
+        else:
+            device = "cpu"
+
+        image = torch.as_tensor(image, dtype=torch.float32, device=device)
+        # FastGeodis expects zeros on the seeds and ones elsewhere
+        mask = torch.as_tensor(annotation.astype(np.uint8) == 0, device=device)
+        GD = FastGeodis.generalised_geodesic3d(
+            image[None, None],
+            mask[None, None].float(),
+            [float(x) for x in spacing],
+            1e10,
+            self.lamb,
+            self.iter,
+        )[0, 0]
+        if self.powerof:
+            GD.pow_(self.powerof)
+
+        if self.logscale == True:
+            GD.neg_().exp_()
+
+        return GD.cpu().numpy()
+
     def __call__(self, data):
-        d = dict(data)
+        d = data
 
         for key in self.keys:
             if self.backup:
@@ -710,37 +776,11 @@ class EGDMapd(MapTransform):
 
             if len(d[key].shape) == 4:
                 for idx in range(d[key].shape[0]):
-                    img = image[idx]
-
-                    GD = GeodisTK.geodesic3d_raster_scan(
-                        img.astype(np.float32),
-                        d[key][idx].astype(np.uint8),
-                        spacing.astype(np.float32),
-                        self.lamb,
-                        self.iter,
+                    d[key][idx, :, :, :] = self.geodesic_map(
+                        image[idx], d[key][idx], spacing
                     )
-                    if self.powerof:
-                        GD = GD**self.powerof
-
-                    if self.logscale == True:
-                        GD = np.exp(-GD)
-
-                    d[key][idx, :, :, :] = GD
             else:
-                GD = GeodisTK.geodesic3d_raster_scan(
-                    image.astype(np.float32),
-                    d[key].astype(np.uint8),
-                    spacing.astype(np.float32),
-                    self.lamb,
-                    self.iter,
-                )
-                if self.powerof:
-                    GD = GD**self.powerof
-
-                if self.logscale == True:
-                    GD = np.exp(-GD)
-
-                d[key] = GD
+                d[key] = self.geodesic_map(image, d[key], spacing)
 
         print(
             f"Geodesic Distance Map with lamd: {self.lamb}, iter: {self.iter} and logscale: {self.logscale}"
@@ -750,7 +790,7 @@ class EGDMapd(MapTransform):
 
 class SavePreprocessed(MapTransform):
     """
-    This transform class saves the preprocessed data to .npz and .pkl files
+    This transform class saves the preprocessed data to .npy and .pkl files
     """
 
     def __init__(
@@ -765,25 +805,28 @@ class SavePreprocessed(MapTransform):
 
     def __call__(self, data):
         d = dict(data)
-        name = (
-            data[f"{self.meta_keys[-1]}"]["filename_or_obj"]
-            .split("/")[-1]
-            .split(".nii.gz")[0]
-        )
+        filename = data[f"{self.meta_keys[-1]}"]["filename_or_obj"]
+        name = Path(filename).name.split(".")[0]
 
-        np.savez(self.save / name, **{key: d[key] for key in self.keys})
+        # One .npy per key, so they can be memory-mapped when loading
+        arrays = self.save / name
+        arrays.mkdir(parents=True, exist_ok=True)
+        for key in self.keys:
+            np.save(arrays / f"{key}.npy", d[key])
+
+        (self.save / f"{name}.npz").unlink(missing_ok=True)
 
         pickle_data = {key: d[key] for key in self.meta_keys}
 
-        with open(self.save / (name + ".pkl"), "wb") as handle:
-            pickle.dump(pickle_data, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        with open(self.save / f"{name}.pkl", "wb") as handle:
+            pickle.dump(pickle_data, handle, protocol=5)
 
         return d
 
 
 class LoadPreprocessed(MapTransform):
     """
-    This transform class loads the preprocessed .npz and .pkl files
+    This transform class loads the preprocessed .npy (or older .npz) and .pkl files
     """
 
     def __init__(
@@ -812,7 +855,17 @@ class LoadPreprocessed(MapTransform):
         new_d = {}
         for key in self.keys:
             current_data = d[key]
-            if current_data.suffix == ".npz":
+            if current_data.is_dir():
+                for new_key in self.new_keys:
+                    array = current_data / f"{new_key}.npy"
+                    if not array.is_file():
+                        raise KeyError(
+                            f"{new_key} is missing from the preprocessed data in {current_data}"
+                        )
+
+                    new_d[new_key] = np.load(array, mmap_mode="c")
+
+            elif current_data.suffix == ".npz":
                 image_data = np.load(d[key])
                 old_keys = list(image_data.keys())
                 if not len(old_keys) == len(self.new_keys):
@@ -854,3 +907,40 @@ class LoadPreprocessed(MapTransform):
                 raise ValueError("Neither npz or pkl in preprocessed loader")
 
         return new_d
+
+
+class ConcatCastToTensord(MapTransform):
+    """
+    This transform class concatenates the keys into one tensor of a single dtype, instead of CastToTyped, ConcatItemsd and ToTensord.
+    """
+
+    def __init__(
+        self,
+        keys: Union[str, List[str]],
+        name: str,
+        dtype: torch.dtype = torch.float32,
+    ) -> None:
+        super().__init__(keys)
+        self.keys = keys
+        self.name = name
+        self.dtype = dtype
+
+    def __call__(self, data):
+        d = dict(data)
+
+        channels = [d[key].shape[0] for key in self.keys]
+        shape = d[self.keys[0]].shape[1:]
+
+        # Output is allocated once, every key is cast while it is copied into its channels
+        output = torch.empty((sum(channels), *shape), dtype=self.dtype)
+        start = 0
+        for key, channel in zip(self.keys, channels):
+            if isinstance(d[key], torch.Tensor):
+                output[start : start + channel].copy_(d[key])
+            else:
+                output.numpy()[start : start + channel] = d[key]
+            start += channel
+
+        d[self.name] = output
+
+        return d
@@ -1,4 +1,5 @@
 import numpy as np
+import torch
 from monai.transforms import Compose, KeepLargestConnectedComponent, FillHoles
 
 
@@ -19,18 +20,20 @@ def ApplyPostprocessing(output, method):
     else:
         return output
 
+    # Tensors are stacked with torch so they stay on their device
+    stack = torch.stack if isinstance(output, torch.Tensor) else np.stack
     if len(output.shape) == 5:
         new_output = []
         for batch in output:
-            new_output.append(np.stack([postprocessing(x) for x in batch], axis=0))
+            new_output.append(stack([postprocessing(x) for x in batch], axis=0))
 
-        output = np.stack(new_output, axis=0)
+        output = stack(new_output, axis=0)
     elif len(output.shape) == 4:
         new_output = []
         for channel in output:
             new_output.append(postprocessing(channel))
 
-        output = np.stack(new_output, axis=0)
+        output = stack(new_output, axis=0)
     else:
         output = postprocessing(output)
 
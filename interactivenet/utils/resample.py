@@ -1,8 +1,12 @@
-from typing import List, Union
+from typing import Callable, List, Sequence, Union
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import torch
+from torch.utils.data import get_worker_info
 
-from skimage.transform import resize
+from scipy.ndimage import zoom
 from nibabel import affines
 import numpy.linalg as npl
 
@@ -12,133 +16,128 @@ from interactivenet.utils.utils import to_array
 def resample_label(
     label: Union[np.ndarray, torch.Tensor], shape: List[int], anisotrophy_flag: bool
 ):
-    reshaped = np.zeros(shape, dtype=np.uint8)
-    n_class = np.max(label)
+    label = to_array(label)[0]
+    zoom_factors = np.divide(shape, label.shape)
+    reshaped = np.zeros((1, *shape), dtype=np.uint8)
     if anisotrophy_flag:
-        shape_2d = shape[:-1]
-        depth = label.shape[-1]
-        reshaped_2d = np.zeros((*shape_2d, depth), dtype=np.uint8)
-
-        for class_ in range(1, int(n_class) + 1):
-            for depth_ in range(depth):
-                mask = label[0, :, :, depth_] == class_
-                resized_2d = resize(
-                    mask.astype(float),
-                    shape_2d,
-                    order=1,
-                    mode="edge",
-                    cval=0,
-                    clip=True,
-                    anti_aliasing=False,
-                )
-                reshaped_2d[:, :, depth_][resized_2d >= 0.5] = class_
-        for class_ in range(1, int(n_class) + 1):
-            mask = reshaped_2d == class_
-            resized = resize(
-                mask.astype(float),
-                shape,
-                order=0,
-                mode="constant",
-                cval=0,
-                clip=True,
-                anti_aliasing=False,
-            )
-            reshaped[resized >= 0.5] = class_
+        # Depth uses nearest neighbour, so only resize the slices it keeps in-plane
+        slices, depth_indices = np.unique(
+            nearest_slices(label.shape[-1], zoom_factors[-1]), return_inverse=True
+        )
+        label = label[:, :, slices]
+        zoom_factors = (*zoom_factors[:-1], 1.0)
+        target = np.zeros((*shape[:-1], len(slices)), dtype=np.uint8)
     else:
-        for class_ in range(1, int(n_class) + 1):
-            mask = label[0] == class_
-            resized = resize(
-                mask.astype(float),
-                shape,
-                order=1,
-                mode="edge",
-                cval=0,
-                clip=True,
-                anti_aliasing=False,
-            )
-            reshaped[resized >= 0.5] = class_
+        target = reshaped[0]
+
+    n_class = np.max(label)
+    for class_ in range(1, int(n_class) + 1):
+        mask = label == class_
+        # Interpolation runs in double precision anyway, a float64 output keeps
+        # voxels that land exactly on the 0.5 threshold stable
+        resized = zoom(
+            mask.astype(np.float32),
+            zoom_factors,
+            output=np.float64,
+            order=1,
+            mode="nearest",
+            grid_mode=True,
+        )
+        target[resized >= 0.5] = class_
+
+    if anisotrophy_flag:
+        np.take(target, depth_indices, axis=-1, out=reshaped[0])
 
-    reshaped = np.expand_dims(reshaped, 0)
     return reshaped
 
 
 def resample_image(
-    image: Union[np.ndarray, torch.Tensor], shape: List[int], anisotrophy_flag: bool
+    image: Union[np.ndarray, torch.Tensor],
+    shape: List[int],
+    anisotrophy_flag: bool,
 ):
-    resized_channels = []
+    image = to_array(image)
+    zoom_factors = np.divide(shape, image.shape[1:])
+    resized = np.empty((len(image), *shape), dtype=image.dtype)
     if anisotrophy_flag:
-        for image_c in image:
-            resized_slices = []
-            for i in range(image_c.shape[-1]):
-                image_c_2d_slice = image_c[:, :, i]
-                image_c_2d_slice = resize(
-                    image_c_2d_slice,
-                    shape[:-1],
-                    order=3,
-                    mode="edge",
-                    cval=0,
-                    clip=True,
-                    anti_aliasing=False,
-                )
-                resized_slices.append(image_c_2d_slice)
-            resized = np.stack(resized_slices, axis=-1)
-            resized = resize(
-                resized,
-                shape,
-                order=0,
-                mode="constant",
-                cval=0,
-                clip=True,
-                anti_aliasing=False,
+        # Depth uses nearest neighbour, so only resize the slices it keeps in-plane
+        slices, depth_indices = np.unique(
+            nearest_slices(image.shape[-1], zoom_factors[-1]), return_inverse=True
+        )
+        resized_2d = np.empty((*shape[:-1], len(slices)), dtype=image.dtype)
+        for c, image_c in enumerate(image):
+            run_tasks(
+                lambda i: resize_spline(
+                    image_c[:, :, slices[i]],
+                    zoom_factors[:-1],
+                    resized_2d[:, :, i],
+                ),
+                range(len(slices)),
             )
-            resized_channels.append(resized)
+            np.take(resized_2d, depth_indices, axis=-1, out=resized[c])
     else:
-        for image_c in image:
-            resized = resize(
-                image_c,
-                shape,
-                order=3,
-                mode="edge",
-                cval=0,
-                clip=True,
-                anti_aliasing=False,
-            )
-            resized_channels.append(resized)
-    resized = np.stack(resized_channels, axis=0)
+        run_tasks(
+            lambda c: resize_spline(image[c], zoom_factors, resized[c]),
+            range(len(image)),
+        )
     return resized
 
 
+def run_tasks(function: Callable, tasks: Sequence):
+    # scipy releases the GIL while zooming, so tasks run in threads. Dataloader workers
+    # and dataset caching threads are already parallel, those run the tasks serially
+    if (
+        len(tasks) < 2
+        or get_worker_info() is not None
+        or threading.current_thread() is not threading.main_thread()
+    ):
+        return [function(task) for task in tasks]
+
+    with ThreadPoolExecutor(max_workers=min(len(tasks), os.cpu_count())) as executor:
+        return list(executor.map(function, tasks))
+
+
+def nearest_slices(depth: int, zoom_factor: float):
+    # The input slice an order 0 zoom picks for every output slice
+    indices = zoom(
+        np.arange(depth, dtype=float),
+        zoom_factor,
+        order=0,
+        mode="nearest",
+        grid_mode=True,
+    )
+    return indices.astype(int)
+
+
+def resize_spline(image: np.ndarray, zoom_factors: List[float], output: np.ndarray):
+    zoom(image, zoom_factors, output=output, order=3, mode="nearest", grid_mode=True)
+    # Cubic splines overshoot, keep the intensities within the original range
+    np.clip(output, image.min(), image.max(), out=output)
+    return output
+
+
 def resample_interaction(
     image: Union[np.ndarray, torch.Tensor],
     affine: Union[np.ndarray, torch.Tensor],
     new_spacing: List[float],
     shape: List[int],
 ):
-    resized_channels = []
     # Sanitize input
     affine = to_array(affine)
-    for image_d in to_array(image):
-        resized = np.zeros(shape)
+    image = to_array(image)
+    resized = np.zeros((len(image), *shape))
+    for c, image_d in enumerate(image):
         new_affine = affines.rescale_affine(
             affine, image_d.shape, new_spacing, new_shape=shape
         )
+        old_vox2new_vox = npl.inv(new_affine).dot(affine)
 
-        inds_x, inds_y, inds_z = np.where(image_d > 0.5)
-        for i, j, k in zip(inds_x, inds_y, inds_z):
-            old_vox2new_vox = npl.inv(new_affine).dot(affine)
-            new_point = np.rint(
-                affines.apply_affine(old_vox2new_vox, [i, j, k])
-            ).astype(int)
-
-            for i in range(len(new_point)):
-                if new_point[i] < 0:
-                    new_point[i] = 0
-                elif new_point[i] >= shape[i]:
-                    new_point[i] = shape[i] - 1
-
-            resized[new_point[0], new_point[1], new_point[2]] = 1
+        points = np.stack(np.where(image_d > 0.5), axis=1)
+        new_points = affines.apply_affine(old_vox2new_vox, points)
+        np.rint(new_points, out=new_points)
+        new_points = new_points.astype(np.intp)
+        np.clip(new_points, 0, np.array(shape) - 1, out=new_points)
 
-        resized_channels.append(resized)
+        resized[c, new_points[:, 0], new_points[:, 1], new_points[:, 2]] = 1
 
-    resized = np.stack(resized_channels, axis=0)
     return resized
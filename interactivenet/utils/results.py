@@ -1,8 +1,13 @@
 from pathlib import Path
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
+import torch
 import matplotlib.pyplot as plt
 
 from monai.transforms import AsDiscrete
+from mlflow.tracking import MlflowClient
 
 from interactivenet.utils.visualize import ImagePlot
 from interactivenet.utils.statistics import (
@@ -12,6 +17,21 @@ from interactivenet.utils.statistics import (
     ComparePlot,
 )
 from interactivenet.utils.postprocessing import ApplyPostprocessing
+from interactivenet.utils.utils import to_array
+
+
+def LogImagePlot(
+    tracking_uri: str,
+    run_id: str,
+    name: str,
+    image: np.ndarray,
+    GT,
+    additional_scans=None,
+    CT: bool = False,
+):
+    f = ImagePlot(image, GT, additional_scans=additional_scans, CT=CT)
+    MlflowClient(tracking_uri=tracking_uri).log_figure(run_id, f, f"images/{name}.png")
+    plt.close("all")
 
 
 def AnalyzeResults(
@@ -21,53 +41,97 @@ def AnalyzeResults(
     argmax = AsDiscrete(argmax=True)
     discrete = AsDiscrete(to_onehot=2)
 
-    dices = {}
-    hausdorff = {}
-    surface = {}
-    classes = {}
-    volume = {}
-    diameter = {}
-    for output in outputs:
-        name = Path(output[1][0]["filename_or_obj"]).name.split(".")[0]
-        pred = output[0][0]
-
-        pred = argmax(pred)
-        pred = ApplyPostprocessing(pred, postprocessing)
-
-        image = output[2]["image_raw"][0]
-        if labels:
-            mask = output[2]["label"][0]
-            f = ImagePlot(
-                image[0],
-                mask[0],
-                additional_scans=[pred[0]],
-                CT=metadata["Fingerprint"]["CT"],
-            )
-
-            pred = discrete(pred)
-            mask = discrete(mask)
-            dice, hausdorff_distance, surface_distance = CalculateScores(pred, mask)
-            dices[name] = dice.item()
-            hausdorff[name] = hausdorff_distance.item()
-            surface[name] = surface_distance.item()
-            classes[name] = output[2]["class"][0]
-
-            (
-                volume_pred,
-                volume_gt,
-                diameter_pred,
-                diameter_gt,
-            ) = CalculateClinicalFeatures(image, pred, mask, output[1][0])
-            volume[name] = {"gt": volume_gt, "pred": volume_pred}
-            diameter[name] = {"gt": diameter_gt, "pred": diameter_pred}
-        else:
-            f = ImagePlot(image[0], output[0], CT=metadata["Fingerprint"]["CT"])
-
-        mlflow.log_figure(f, f"images/{name}.png")
+    # Argmax, postprocessing and scores run on the gpu if there is one
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    # Figures are drawn and logged in separate processes, as pyplot is not thread-safe
+    with ProcessPoolExecutor(
+        max_workers=2, mp_context=multiprocessing.get_context("spawn")
+    ) as plotting:
+        plots = []
+        plot_args = (mlflow.get_tracking_uri(), mlflow.active_run().info.run_id)
+
+        names = []
+        scores = []
+        classes = {}
+        volume = {}
+        diameter = {}
+        for output in outputs:
+            name = Path(output[1][0]["filename_or_obj"]).name.split(".")[0]
+            pred = torch.as_tensor(output[0][0], device=device)
+
+            pred = argmax(pred)
+            pred = ApplyPostprocessing(pred, postprocessing)
+
+            image = to_array(output[2]["image_raw"][0])
+            if labels:
+                mask = torch.as_tensor(output[2]["label"][0], device=device)
+
+                pred = discrete(pred)
+                mask = discrete(mask)
+                dice, hausdorff_distance, surface_distance = CalculateScores(pred, mask)
+                names.append(name)
+                scores.append(
+                    torch.cat(
+                        [
+                            dice.flatten(),
+                            hausdorff_distance.flatten().to(dice.device),
+                            surface_distance.flatten().to(dice.device),
+                        ]
+                    )
+                )
+                classes[name] = output[2]["class"][0]
+
+                # Single copy to the cpu, shared by the figure and the clinical features
+                pred, mask = to_array(pred), to_array(mask)
+                plots.append(
+                    plotting.submit(
+                        LogImagePlot,
+                        *plot_args,
+                        name,
+                        image[0],
+                        mask[1],
+                        additional_scans=[pred[1]],
+                        CT=metadata["Fingerprint"]["CT"],
+                    )
+                )
+
+                (
+                    volume_pred,
+                    volume_gt,
+                    diameter_pred,
+                    diameter_gt,
+                ) = CalculateClinicalFeatures(image, pred, mask, output[1][0])
+                volume[name] = {"gt": volume_gt, "pred": volume_pred}
+                diameter[name] = {"gt": diameter_gt, "pred": diameter_pred}
+            else:
+                plots.append(
+                    plotting.submit(
+                        LogImagePlot,
+                        *plot_args,
+                        name,
+                        image[0],
+                        [to_array(x) for x in output[0]],
+                        CT=metadata["Fingerprint"]["CT"],
+                    )
+                )
+
+        for plot in plots:
+            plot.result()
 
     if labels:
-        mlflow.log_metric("Mean dice", np.mean(list(dices.values())))
-        mlflow.log_metric("Std dice", np.std(list(dices.values())))
+        # Single conversion for all cases, instead of an .item() per metric per case
+        scores = torch.stack(scores) if scores else torch.empty((0, 3))
+        mean_dice, std_dice = torch.stack(
+            [scores[:, 0].mean(), scores[:, 0].std(unbiased=False)]
+        ).tolist()
+        scores = scores.tolist()
+        dices = {name: score[0] for name, score in zip(names, scores)}
+        hausdorff = {name: score[1] for name, score in zip(names, scores)}
+        surface = {name: score[2] for name, score in zip(names, scores)}
+
+        mlflow.log_metric("Mean dice", mean_dice)
+        mlflow.log_metric("Std dice", std_dice)
 
         f = ResultPlot(dices, "Dice", classes)
         plt.close("all")
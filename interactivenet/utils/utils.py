@@ -2,6 +2,10 @@ from typing import Dict, Optional, Union
 
 import os
 import json
+import shutil
+import tempfile
+from collections import OrderedDict
+from collections.abc import Mapping
 from pathlib import Path
 
 import numpy as np
@@ -11,6 +15,7 @@ import nibabel as nib
 import SimpleITK as sitk
 
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 import pickle
 
@@ -46,25 +51,41 @@ def save_niftis(mlflow, outputs: list, postprocessing: str):
 def save_weights(mlflow, outputs: list):
     tmp_dir = Path("/tmp/", str(uuid.uuid4()))
     print(f"saving weights to {tmp_dir} before moving to artifacts.")
-    for output in outputs:
-        name = Path(output[1][0]["filename_or_obj"]).name.split(".")[0]
-        weights = output[0][0]
-        meta = output[1][0]
+    tmp_dir.mkdir(parents=True, exist_ok=True)
 
-        tmp_dir.mkdir(parents=True, exist_ok=True)
+    # The active run is not visible from other threads, so log to it explicitly
+    run_id = mlflow.active_run().info.run_id
+    client = mlflow.tracking.MlflowClient()
+
+    def save(name: str, weights: np.ndarray, meta: dict):
         data_file = tmp_dir / f"{name}.npz"
 
         np.savez(str(data_file), weights=weights)
-        mlflow.log_artifact(str(data_file), artifact_path="weights")
+        client.log_artifact(run_id, str(data_file), artifact_path="weights")
         data_file.unlink()
 
         data_file = tmp_dir / f"{name}.pkl"
         with open(str(data_file), "wb") as handle:
             pickle.dump(meta, handle, protocol=pickle.HIGHEST_PROTOCOL)
 
-        mlflow.log_artifact(str(data_file), artifact_path="weights")
+        client.log_artifact(run_id, str(data_file), artifact_path="weights")
         data_file.unlink()
 
+    # Writing and uploading a case overlaps with the next one
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [
+            executor.submit(
+                save,
+                Path(output[1][0]["filename_or_obj"]).name.split(".")[0],
+                output[0][0],
+                output[1][0],
+            )
+            for output in outputs
+        ]
+
+    for future in futures:
+        future.result()
+
     tmp_dir.rmdir()
 
 
@@ -134,6 +155,105 @@ def read_dataset(datapath: Union[str, os.PathLike], mode="train", error_message=
             raise KeyError(f"dataset.json does not exist at path: {datapath}")
 
 
+class NiftiCase(Mapping):
+    """
+    Raw niftis of a single case, volumes are read when a key is first requested.
+    Loaded volumes are kept in a cache shared with the other cases of the same NiftiReader.
+    """
+
+    def __init__(
+        self,
+        idx: Dict,
+        raw_path: Path,
+        rename_image: Optional[str] = "image_raw",
+        labels: bool = False,
+        cache: Optional[OrderedDict] = None,
+        cache_size: int = 3,
+    ):
+        self.raw_path = raw_path
+        self.idx = idx
+        self.cache = cache if cache is not None else OrderedDict()
+        self.cache_size = cache_size
+        self.files = {
+            rename_image if rename_image else "image": idx["image"],
+            "interaction": idx["interaction"],
+        }
+        self.meta_files = {
+            "image_meta_dict": idx["image"],
+            "interaction_meta_dict": idx["interaction"],
+        }
+        if labels:
+            self.files["label"] = idx["label"]
+            self.meta_files["label_meta_dict"] = idx["label"]
+
+    def __getitem__(self, key: str):
+        # Values are in a list to match batch output
+        if key == "class":
+            return [self.idx["class"]]
+        elif key in self.meta_files:
+            return [nib.load(self.raw_path / self.meta_files[key]).header]
+
+        path = self.raw_path / self.files[key]
+        if (key, path) in self.cache:
+            self.cache.move_to_end((key, path))
+        else:
+            # Read through dataobj to skip the float64 copy made by get_fdata
+            img = nib.load(path)
+            dtype = np.uint8 if key == "label" else np.float32
+            volume = np.asarray(img.dataobj, dtype=dtype)
+            self.cache[(key, path)] = volume[None, :]  # Adding a channel
+            # Only the most recent volumes are kept, references to every case stay cheap
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+        return [self.cache[(key, path)]]
+
+    def __iter__(self):
+        yield from self.files
+        yield from self.meta_files
+        yield "class"
+
+    def __len__(self):
+        return len(self.files) + len(self.meta_files) + 1
+
+
+class NiftiReader(Mapping):
+    """
+    Read-only mapping from name to the raw niftis of that case, see NiftiCase
+    """
+
+    def __init__(
+        self,
+        data: Dict,
+        raw_path: Optional[Union[str, os.PathLike]],
+        rename_image: Optional[str] = "image_raw",
+        labels: bool = False,
+    ):
+        self.raw_path = to_pathlib(raw_path)
+        self.rename_image = rename_image
+        self.labels = labels
+        self.data = {Path(idx["interaction"]).name.split(".")[0]: idx for idx in data}
+        # Enough for every volume of a single case
+        self.cache = OrderedDict()
+        self.cache_size = 3
+
+    def __getitem__(self, name: str):
+        return NiftiCase(
+            self.data[name],
+            self.raw_path,
+            self.rename_image,
+            self.labels,
+            cache=self.cache,
+            cache_size=self.cache_size,
+        )
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+
 def read_nifti(
     data: Dict,
     raw_path: Optional[Union[str, os.PathLike]],
@@ -141,47 +261,30 @@ def read_nifti(
 ):
     labels = all([x["label"] != "" for x in data])
 
-    raw_path = to_pathlib(raw_path)
-    loaded_data = {}
-    for idx in data:
-        idx_data = {}
-        name = Path(idx["interaction"]).name.split(".")[0]
-
-        img = nib.load(raw_path / idx["image"])
-        if rename_image:
-            idx_data[rename_image] = [
-                img.get_fdata()[None, :]
-            ]  # Adding a channel and in list to match batch output
-        else:
-            idx_data["image"] = [img.get_fdata()[None, :]]
-
-        idx_data["image_meta_dict"] = [img.header]
-
-        inter = nib.load(raw_path / idx["interaction"])
-        idx_data["interaction"] = [inter.get_fdata()[None, :]]
-        idx_data["interaction_meta_dict"] = [inter.header]
-
-        idx_data["class"] = [idx["class"]]
-
-        if labels:
-            label = nib.load(raw_path / idx["label"])
-            idx_data["label"] = [label.get_fdata()[None, :]]
-            idx_data["label_meta_dict"] = [label.header]
-
-        loaded_data.update({name: idx_data})
-
-    return loaded_data, labels
+    return NiftiReader(data, raw_path, rename_image, labels), labels
 
 
 def read_processed(datapath: Union[str, os.PathLike]):
     datapath = to_pathlib(datapath)
 
-    arrays = sorted(
-        [x for x in (datapath / "network_input").glob("**/*.npz") if x.is_file()]
-    )
-    metafile = sorted(
-        [x for x in (datapath / "network_input").glob("**/*.pkl") if x.is_file()]
-    )
+    # Single pass over the directory, scandir entries know their type without a stat
+    arrays, npz_files, metafile = set(), [], []
+    with os.scandir(datapath / "network_input") as entries:
+        for entry in entries:
+            if entry.name.startswith("."):
+                # Unfinished conversions from npz_to_npy
+                continue
+            elif entry.is_dir():
+                arrays.add(Path(entry.path))
+            elif entry.name.endswith(".npz"):
+                npz_files.append(Path(entry.path))
+            elif entry.name.endswith(".pkl") and entry.is_file():
+                metafile.append(Path(entry.path))
+
+    # Older .npz files are still loaded, unless they have been converted to .npy
+    arrays.update(x for x in npz_files if x.with_suffix("") not in arrays)
+    arrays = sorted(arrays)
+    metafile.sort()
 
     if len(arrays) != len(metafile):
         raise ValueError("not the same number files for arrays and metafile")
@@ -192,6 +295,32 @@ def read_processed(datapath: Union[str, os.PathLike]):
     ]
 
 
+def npz_to_npy(npz_path: Union[str, os.PathLike]):
+    # Unpack an older compressed .npz into the .npy per key layout of SavePreprocessed,
+    # so it can be memory-mapped. The arrays are written to a hidden temporary directory
+    # which is renamed into place once complete, the .npz itself is left untouched.
+    npz_path = to_pathlib(npz_path)
+    arrays = npz_path.with_suffix("")
+    if arrays.is_dir():
+        return arrays
+
+    tmp = Path(tempfile.mkdtemp(prefix=f".{arrays.name}.", dir=arrays.parent))
+    try:
+        with np.load(npz_path) as npz:
+            for key in npz.files:
+                np.save(tmp / f"{key}.npy", npz[key])
+
+        os.rename(tmp, arrays)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        # Another run converted the same file in the meantime
+        if arrays.is_dir():
+            return arrays
+        raise
+
+    return arrays
+
+
 def read_metadata(metapath: Union[str, os.PathLike], error_message=None):
     metapath = to_pathlib(metapath)
 
@@ -239,10 +368,18 @@ def to_sitk(data: Union[np.ndarray, torch.Tensor], meta: Dict):
         raise KeyError(f"please provide array or tensor not: {type(data)}")
 
     data = sitk.GetImageFromArray(data, isVector=False)
-    data.SetSpacing(np.array(meta["pixdim"][1:4], dtype="float32").tolist())
+    data.SetSpacing([float(x) for x in meta["pixdim"][1:4]])
     return data
 
 
+def uncompressed_name(filename: Union[str, os.PathLike]):
+    filename = to_pathlib(filename)
+    if filename.suffix == ".gz":
+        filename = filename.with_suffix("")
+
+    return filename
+
+
 def to_pathlib(datapath: Union[str, os.PathLike]):
     if isinstance(datapath, str):
         datapath = Path(datapath)
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("GeodisTK")
+pytest.importorskip("FastGeodis")
+
+from interactivenet.transforms.transforms import EGDMapd
+
+
+def small_case():
+    rng = np.random.default_rng(0)
+    image = np.zeros((32, 32, 12), dtype=np.float32)
+    image[8:24, 8:24, 3:9] = 2
+    image += rng.normal(scale=0.1, size=image.shape).astype(np.float32)
+
+    interaction = np.zeros_like(image)
+    interaction[15:17, 15:17, 5:7] = 1
+    interaction[8, 8, 3] = 1
+    return image, interaction, np.array([1.0, 1.0, 3.0])
+
+
+@pytest.mark.parametrize("powerof", [False, 2])
+def test_fastgeodis_matches_geodistk(powerof):
+    image, interaction, spacing = small_case()
+
+    maps = {}
+    for backend in ["geodistk", "fastgeodis"]:
+        egd = EGDMapd(
+            keys=["interaction"],
+            image="image",
+            lamb=1,
+            iter=4,
+            logscale=True,
+            powerof=powerof,
+            backend=backend,
+        )
+        maps[backend] = egd.geodesic_map(image, interaction, spacing)
+
+    assert maps["geodistk"].shape == maps["fastgeodis"].shape
+    # Both are one on the interactions themselves
+    np.testing.assert_allclose(maps["fastgeodis"][interaction > 0], 1, atol=1e-6)
+    # The raster scans are not bit-identical, but should agree closely
+    np.testing.assert_allclose(maps["fastgeodis"], maps["geodistk"], atol=1e-2)
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        EGDMapd(keys=["interaction"], image="image", backend="unknown")